@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
 A simple utility to translate among the SRAM/EEPROM/Flash dump formats for
@@ -58,9 +58,6 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from __future__ import (absolute_import, division, print_function,
-                        with_statement, unicode_literals)
-
 __author__ = "Stephan Sokolow"
 __license__ = "MIT"
 __appname__ = "N64-Saveswap"
@@ -69,57 +66,31 @@ __version__ = "0.1"
 # A list of valid dump sizes, used for safety checks and padding
 VALID_SIZES = [512, 2048, 32768, 131072]
 
-import logging, os, shutil, sys, textwrap
+import array, bisect, logging, os, shutil, sys, textwrap
+from functools import partial
 log = logging.getLogger(__name__)
 
-if sys.version_info.major > 2:  # pragma: nocover
-    def reload(_):  # pylint: disable=redefined-builtin
-        """Silence a spurious 'Undefined variable' error in Landscape.io"""
-        pass
+# Only needed for the type comments, and not in the stdlib before Python 3.5
+try:
+    from typing import (  # NOQA pylint: disable=unused-import
+        Callable, Dict, Tuple, Union)
+except ImportError:  # pragma: nocover
+    pass
 
 # A little safety guard against programmer error
 assert all(x % 4 == 0 for x in VALID_SIZES), "VALID_SIZES contains bad value"
 VALID_SIZES.sort()
 
+# array() type codes name C types rather than sizes (eg. 'L' is 32 bits on
+# Windows but 64 bits on x86_64 Linux), so look up the one that's 32 bits here
+_UINT32 = [x for x in 'IL' if array.array(x).itemsize == 4][0]
+
 class FileTooBig(Exception):
     """Exception raised for files bigger than the last entry in VALID_SIZES"""
 
 class FileIncomplete(Exception):
     """Exception raised for files not a multiple of the swap increment."""
 
-def rejoin_bytes(sequence):  # type: (...) -> bytes
-    """Create a bytestring from whatever you get by iterating on one.
-
-    This is a workaround for the following situation:
-
-        1. In Python 2.7, iterating on a bytestring will give you a sequence of
-           characters, which you rejoin with ``b''.join(sequence)`` and calling
-           ``bytes([65 , 66, 67])`` gives you a string containing
-           ``[65, 66, 67]``.
-
-        2. In Python 3.x, iterating on a bytestring will give you a sequence of
-           integers, which you rejoin with ``bytes(sequence)`` and
-           ``b''.join(sequence)`` will raise an error because it doesn't know
-           how to join integers.
-
-    ...just be thankful I didn't get fed up enough to use
-    .decode('latin1') and .encode('latin1') to side-step it by pretending that
-    the Unicode codepoints corresponding to the latin-1 encoding are raw byte
-    values.
-
-    (Not a good idea, if you can avoid it, because it wastes memory supporting
-     values you'll never use, wastes CPU time converting both ways, and, if you
-     pick an encoding that can't represent all 256 possible byte values or
-     accidentally introduce Unicode values that can't be mapped back, you'll
-     set yourself up for unpleasant surprises.)
-    """
-    if sys.version_info.major < 3:
-        # Python 2.7
-        return b''.join(sequence)  # pragma: nocover
-    else:
-        # Python 3.x and beyond
-        return bytes(sequence)     # pragma: nocover
-
 def calculate_padding(path):  # type: (str) -> int
     """Calculate the size that a dump file should be padded to.
 
@@ -136,12 +107,12 @@ def calculate_padding(path):  # type: (str) -> int
     # Get the file size in bytes or raise OSError
     file_size = os.path.getsize(path)
 
-    # Walking from smallest to largest (see definition of VALID_SIZES),
-    # return the first value from VALID_SIZES that matches or exceeds
-    # the file's current size
-    for size in VALID_SIZES:
-        if size >= file_size:
-            return size
+    # Since VALID_SIZES is sorted (see its definition), bisect_left can do a
+    # binary search for the index of the first value that matches or exceeds
+    # the file's current size.
+    index = bisect.bisect_left(VALID_SIZES, file_size)
+    if index < len(VALID_SIZES):
+        return VALID_SIZES[index]
 
     # If we got this far, file_size is bigger than the biggest size in the list
     raise FileTooBig("File already exceeds largest valid size."
@@ -154,11 +125,76 @@ def assert_stride(data, stride_len):
         raise FileIncomplete("File length is not divisible by {}: {}"
                              "".format(stride_len, file_len))
 
-def byteswap(path, swap_bytes=True, swap_words=True, pad_to=0):
-    # type: (str, bool, bool, int) -> None
+def _swap_halves(data):  # type: (bytearray) -> None
+    """Swap the 16-bit halves of each 32-bit word in a bytearray in place"""
+    data[0::4], data[1::4], data[2::4], data[3::4] = (
+        data[2::4], data[3::4], data[0::4], data[1::4])
+
+# For each (swap_bytes, swap_words) combination, the type to copy the data
+# into and the function which will swap it in place in a single pass.
+#
+# (Reversing all four bytes of a 32-bit word is the same thing as swapping
+#  the bytes within each 16-bit half and then swapping the halves, so doing
+#  both only takes one byteswap() call on 32-bit words rather than two passes)
+_SWAP_MODES = {  # type: Dict[Tuple[bool, bool], Tuple[Callable, Callable]]
+    (True, False): (partial(array.array, 'H'), array.array.byteswap),
+    (False, True): (bytearray, _swap_halves),
+    (True, True): (partial(array.array, _UINT32), array.array.byteswap),
+}
+
+def swap_data(data, swap_bytes=True, swap_words=True):
+    # type: (bytes, bool, bool) -> Union[bytes, bytearray, array.array]
+    """Perform requested swapping operations on an in-memory bytestring.
+
+    See `byteswap` for argument documentation.
+
+    :rtype: `bytes`, `bytearray`, or `array.array`
+    :returns: The swapped data, as either the input bytestring (if no swapping
+        was requested) or a buffer that can be passed to ``write()`` directly.
+
+    :raises FileIncomplete:
+        The length of ``data`` isn't a multiple of the requested swapping
+        increment.
+    """
+    # Rather than looping over the data in Python, we hand it to types from
+    # the standard library which can do the actual shuffling in C:
+    #
+    #   array.array('H', data) reinterprets the bytestring "12345678" as the
+    #   16-bit words "12", "34", "56", "78" without any per-byte Python work.
+    #   (Or as the 32-bit words "1234", "5678" with the `_UINT32` type code.)
+    #
+    #   .byteswap() reverses the bytes within each word in place:
+    #     'H': "12" "34" "56" "78" -> "21" "43" "65" "87"
+    #     32-bit: "1234" "5678" -> "4321" "8765"
+    #
+    #   Assigning to slices of a bytearray (see `_swap_halves`) moves whole
+    #   columns of bytes at once, which is how we swap the 16-bit halves:
+    #     [0::4] means "take every fourth byte starting with the first"
+    #     [2::4] means "take every fourth byte starting with the third"
+    #     "12345678" -> "34127856"
+    #
+    # TODO: Are these files ALWAYS supposed to be multiples of 4 bytes when
+    #       dumped? If so, I should enforce that unconditionally to catch
+    #       corruption as broadly as possible.
+    if not (swap_bytes or swap_words):
+        return data
+
+    # Check up front, since the swaps assume they're working on whole words
+    # (and array() would reject odd lengths with a less helpful error)
+    assert_stride(data, 4 if swap_words else 2)
+
+    buffer_type, swap_func = _SWAP_MODES[(swap_bytes, swap_words)]
+    swapped = buffer_type(data)
+    swap_func(swapped)
+    return swapped
+
+def byteswap(path, swap_bytes=True, swap_words=True, pad_to=0,
+             make_backup=True):
+    # type: (str, bool, bool, int, bool) -> None
     """Perform requested swapping operations on the given file.
 
-    A backup file will be generated by appending ``.bak`` to the path.
+    Unless ``make_backup`` is ``False``, a backup file will be generated by
+    appending ``.bak`` to the path.
 
     :Parameters:
       path : `str`
@@ -174,6 +210,11 @@ def byteswap(path, swap_bytes=True, swap_words=True, pad_to=0):
       pad_to : `int`
         If specified, append null bytes before writing to ensure the file is
         at least this length.
+      make_backup : `bool`
+        If ``True``, write a copy of the original data to ``path + '.bak'``
+        before overwriting it. This happens after the new data has been
+        prepared, so errors like `FileIncomplete` won't leave behind a
+        backup file.
 
     :raises TypeError: The value of ``path`` is not a string.
     :raises IOError: Failure when attempting to read/write a file.
@@ -186,64 +227,60 @@ def byteswap(path, swap_bytes=True, swap_words=True, pad_to=0):
     #
     # It's less error-prone and it's (comparatively) slow to keep switching
     # into the OS kernel for a lot of little read() calls.
-    with open(path, 'rb') as fobj_in:
-        data = fobj_in.read()
-
-    # OK, this is a little fancy, so I'll explain the parts in detail:
-    #
-    #   [0::4] means "take every fourth character starting with the first.
-    #   [1::4] means "take every fourth character starting with the second.
-    #     "123412341234" becomes "111" and "222" and so on.
-    #
-    #   zip() turns a list of rows into a list of columns
-    #     [["4","4","4"], ["3","3","3"], ["2","2","2"], ["1","1","1"]]
-    #       becomes
-    #     [["4","3","2","1"], ["4","3","2","1"], ["4","3","2","1"]]
-    #
-    #   rejoin_bytes() turns a list of bytes into a bytestring.
-    #
-    #   b''.join() turns a list of bytestrings into a single bytestring,
-    #   using "nothing" as the separator. ('' and "" are interchangeable)
-    #     ["4", "3", "2", "1"] -> "4321"
-    #
-    #   Things of the form ``output = [something for x in data]`` are
-    #   "list comprehensions" and what you see is shorthand for:
-    #     output2 = []
-    #     for x in output:
-    #         output2.append(rejoin_bytes(x))
-    #     output = b''.join(output2)
-    #     del output2
-    #
-    # TODO: Are these files ALWAYS supposed to be multiples of 4 bytes when
-    #       dumped? If so, I should enforce that unconditionally to catch
-    #       corruption as broadly as possible.
-    file_len = len(data)
-    if swap_bytes:
-        assert_stride(data, 2)
-        data = zip(data[1::2], data[0::2])  # type: ignore
-        data = b''.join([rejoin_bytes(x) for x in data])
-
-    if swap_words:
-        assert_stride(data, 4)
-        data = zip(data[2::4], data[3::4],  # type: ignore
-                   data[0::4], data[1::4])
-        data = b''.join([rejoin_bytes(x) for x in data])
-
-    # Now, apply padding if requested
     #
-    # In Python, multiplying a string by an int repeats the string.
-    #   'Foo' * 3 -> 'FooFooFoo'
-    if pad_to > file_len:
-        data = data + (b'\x00' * (pad_to - file_len))
-
-    # Now, overwrite the old data with the new data
-    #
-    # The file will automatically be wiped clean when calling open() with
-    # 'w' in the mode and this, while not infallible, is hard to screw up
-    # because we only open the file after all the tricky bits are done.
-    #
-    with open(path, 'wb') as fobj_out:
-        fobj_out.write(data)
+    # We open the file with 'r+b' ("read and update, in binary mode") so we can
+    # overwrite it in place through the same handle once the new data is
+    # ready. Rewriting the existing file rather than replacing it with a new
+    # one means symlinks, hardlinks, ownership, and permissions all stay
+    # exactly as they were... and a read-only file is refused up front.
+    with open(path, 'r+b') as fobj:
+        original = fobj.read()
+        file_len = len(original)
+        data = swap_data(original, swap_bytes, swap_words)
+
+        if make_backup:
+            # We already have the original contents in memory, so write the
+            # backup from that rather than having shutil.copy2() read the
+            # whole file a second time. (copystat() then copies over the
+            # metadata, like modification date, that copy2() would have.)
+            bak_path = path + '.bak'
+            with open(bak_path, 'wb') as fobj_bak:
+                fobj_bak.write(original)
+            shutil.copystat(path, bak_path)
+
+        # Now, overwrite the old data with the new data
+        #
+        # This, while not infallible, is hard to screw up because we only
+        # start writing after all the tricky bits are done and the swapped
+        # data is exactly as long as what it replaces, so there are no
+        # leftovers from the old contents to clean up afterward.
+        #
+        # (Bytestrings, bytearrays and arrays can all go to write() directly)
+        fobj.seek(0)
+        fobj.write(data)
+
+        # Now, apply padding if requested
+        #
+        # Rather than building a string of null bytes and writing it out, we
+        # just tell the OS to make the file longer. Extending a file this way
+        # fills the new space with null bytes without us having to supply
+        # them, and filesystems can often do it without writing anything.
+        if pad_to > file_len:
+            fobj.truncate(pad_to)
+
+def file_identity(path):  # type: (str) -> object
+    """Return a value which is equal for any two paths to the same file.
+
+    For files which exist, this is their device and inode numbers, so it
+    sees through symlinks, hardlinks, and differences in case on
+    case-insensitive filesystems. For anything else, it falls back to the
+    normalized absolute path.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return os.path.normcase(os.path.abspath(path))
+    return (stat.st_dev, stat.st_ino)
 
 def process_path(path, swap_bytes=True, swap_words=True, pad_to=None,
                  make_backup=True):
@@ -258,8 +295,8 @@ def process_path(path, swap_bytes=True, swap_words=True, pad_to=None,
     :Parameters:
       make_backup : `bool`
         If `True`, generate a backup file by appending `.bak` to the path.
-        This will happen after detecting oversize files but before performing
-        any actual work.
+        This will happen after detecting oversize files and incompatible
+        lengths but before writing anything.
 
     :raises TypeError: The value of ``path`` is not a string.
     :raises IOError: Failure when attempting to read/write a file.
@@ -270,25 +307,10 @@ def process_path(path, swap_bytes=True, swap_words=True, pad_to=None,
     elif not pad_to:    # Anything else False-y (eg. 0) means "No padding."
         pad_to = 0
 
-    if make_backup:
-        bak_path = path + '.bak'
-
-        # Don't get fancy. Just let a well-tested routine make our backup
-        # (copy2 also preserves metadata like modification date)
-        shutil.copy2(path, bak_path)
-
-    byteswap(path, swap_bytes, swap_words, pad_to)
+    byteswap(path, swap_bytes, swap_words, pad_to, make_backup)
 
 def main():  # type: () -> None
     """The main entry point, compatible with setuptools entry points."""
-    # If we're running on Python 2, take responsibility for preventing
-    # output from causing UnicodeEncodeErrors. (Done here so it should only
-    # happen when not being imported by some other program.)
-    if sys.version_info.major < 3:  # pragma: nocover
-        # pylint: disable=no-member
-        reload(sys)                      # type: ignore
-        sys.setdefaultencoding('utf-8')  # type: ignore
-
     # Define a command-line argument parser which handles things like --help
     # and enforcing requirements for what arguments must be provided
     from argparse import ArgumentParser, RawDescriptionHelpFormatter
@@ -352,9 +374,9 @@ def main():  # type: () -> None
     logging.basicConfig(level=log_levels[args.verbose],       # type: ignore
                         format='%(levelname)s: %(message)s')
 
-    # Adapt the external interface to the internal one and process each file
-    retcode = 0
-    for path in args.path:
+    # Adapt the external interface to the internal one
+    def process_one(path):  # type: (str) -> int
+        """Process a single path and return the exit code it calls for"""
         log.info("Processing %s...", path)
         try:
             process_path(path=path,
@@ -362,17 +384,35 @@ def main():  # type: () -> None
                 swap_words=args.swap_mode in ('both', 'words-only'),
                 pad_to=args.pad_to,
                 make_backup=args.backup)
-
-        # Return the most serious error code we encountered
         except (IOError, OSError) as err:
-            retcode = max(retcode, 10)
             log.error("Error while trying to read file: %s\n\t%s", path, err)
-        except FileTooBig as err:
-            retcode = max(retcode, 20)
+            return 10
+        except FileTooBig:
             log.error("File is too big to be an N64 save dump: %s", path)
-        except FileIncomplete as err:
-            retcode = max(retcode, 30)
+            return 20
+        except FileIncomplete:
             log.error("File is incompatible with requested swap: %s", path)
+            return 30
+        return 0
+
+    # Most of the time spent on each file is waiting for the disk, so let a
+    # pool of threads process several files at once.
+    #
+    # ...unless some of them are the same file (or one's backup) under
+    # different names, in which case the order they're processed in matters
+    # and we fall back to doing them one at a time.
+    from concurrent.futures import ThreadPoolExecutor
+    file_ids = set(file_identity(x) for x in args.path)
+    bak_ids = set(file_identity(os.path.abspath(x) + '.bak')
+                  for x in args.path)
+    if len(file_ids) < len(args.path) or file_ids & bak_ids:
+        workers = 1
+    else:
+        workers = min(8, len(args.path))
+
+    # Return the most serious error code we encountered
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        retcode = max(executor.map(process_one, args.path))
 
     if retcode != 0:
         sys.exit(retcode)
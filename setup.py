@@ -6,6 +6,9 @@ from setuptools import setup
 __author__ = "Stephan Sokolow"
 __license__ = "MIT"
 
+# Matches the ``__version__ = "..."`` line in a module's source
+VERSION_RE = re.compile(r"^__version__\s*=\s*['\"]([^'\"]*)['\"]", re.M)
+
 # Get the version from the program rather than duplicating it here
 # Source: https://packaging.python.org/en/latest/single_source_version.html
 def read(*names, **kwargs):
@@ -17,8 +20,7 @@ def read(*names, **kwargs):
 def find_version(*file_paths):
     """Extract the value of __version__ from the given file"""
     version_file = read(*file_paths)
-    version_match = re.search(r"^__version__\s*=\s*['\"]([^'\"]*)['\"]",
-                              version_file, re.M)
+    version_match = VERSION_RE.search(version_file)
     if version_match:
         return version_match.group(1)
     raise RuntimeError("Unable to find version string.")
@@ -40,13 +42,13 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Topic :: Utilities',
     ],
     keywords=('byteswap byteswapping endian endianness dump n64 sram '
               'eeprom flash'),
     license="MIT",
+    python_requires='>=3.4',
     py_modules=['saveswap'],
     entry_points={
         'console_scripts': [
@@ -3,20 +3,30 @@
 As this relies on helpers from py.test, it must be run with ``py.test``.
 """
 
-from __future__ import (absolute_import, division, print_function,
-                        with_statement, unicode_literals)
-
 __author__ = "Stephan Sokolow"
 __license__ = "MIT"
 __appname__ = "N64-Saveswap"
 __version__ = "0.0pre0"
 
-import os, sys
+import concurrent.futures, os, sys
 from contextlib import contextmanager
 
+import pytest
+
 from saveswap import (calculate_padding, byteswap, main, process_path,
                       FileIncomplete, FileTooBig)
 
+# Payloads shared by several tests, built once at import rather than on
+# every use. (400000 bytes is bigger than any valid N64 save dump.)
+BIG_DUMP = b"1234" * 100000
+BIG_DUMP_SWAPPED = b"4321" * 100000
+BIG_DUMP_PADDED = BIG_DUMP_SWAPPED + b"\x00" * 100000  # pad_to=500000
+
+@pytest.fixture
+def fake_dump(tmp_path):
+    """Path for a dump file in a temporary directory private to the test"""
+    return tmp_path / "fake_dump"
+
 @contextmanager
 def set_argv(args):
     """Context manager to temporarily modify sys.argv"""
@@ -27,100 +37,117 @@ def set_argv(args):
     finally:
         sys.argv = old_argv
 
-def test_calculate_padding(tmpdir):
+def test_calculate_padding(monkeypatch):
     """Test that calculate_padding works as expected"""
-    import pytest
-    test_file = tmpdir.join("fake_dump")
+    # calculate_padding only looks at the size, so skip writing real files
+    file_sizes = {}
+    monkeypatch.setattr("saveswap.os.path.getsize", file_sizes.__getitem__)
 
     for start, expected in (
-            (100, 512), (500, 2048), (1000, 32768), (10000, 131072)):
-        test_file.write("1234" * start)
-        assert calculate_padding(str(test_file)) == expected
+            (0, 512), (400, 512), (512, 512), (513, 2048), (2000, 2048),
+            (4000, 32768), (40000, 131072), (131072, 131072)):
+        file_sizes["fake_dump"] = start
+        assert calculate_padding("fake_dump") == expected
 
-    test_file.write("1234" * 100000)
+    file_sizes["fake_dump"] = 400000
     with pytest.raises(FileTooBig):
-        calculate_padding(str(test_file))
-
-def test_byteswap(tmpdir):
-    """Test that byteswap produces the expected output"""
-    test_file = tmpdir.join("fake_dump")
-
-    # Test the various modes
-    for options, expected in (
-            ({}, "4321"),
-            ({'swap_bytes': False}, "3412"),
-            ({'swap_words': False}, "2143"),
-            ({'swap_bytes': False, 'swap_words': False}, "1234")):
-        test_file.write("1234" * 10)
-        byteswap(str(test_file), **options)
-        assert test_file.read() == expected * 10
-
-def test_byteswap_padding(tmpdir):
+        calculate_padding("fake_dump")
+
+@pytest.mark.parametrize("options,expected", (
+        ({}, b"4321"),
+        ({'swap_bytes': False}, b"3412"),
+        ({'swap_words': False}, b"2143"),
+        ({'swap_bytes': False, 'swap_words': False}, b"1234")))
+def test_byteswap(fake_dump, options, expected):
+    """Test that byteswap produces the expected output in each mode"""
+    fake_dump.write_bytes(b"1234" * 10)
+    byteswap(str(fake_dump), **options)
+    assert fake_dump.read_bytes() == expected * 10
+
+def test_byteswap_no_backup(fake_dump):
+    """Test that byteswap only makes a backup when asked"""
+    backup_path = str(fake_dump) + '.bak'
+
+    fake_dump.write_bytes(b"1234" * 10)
+    byteswap(str(fake_dump), make_backup=False)
+    assert fake_dump.read_bytes() == b"4321" * 10
+    assert not os.path.exists(backup_path)
+
+    byteswap(str(fake_dump), make_backup=True)
+    assert fake_dump.read_bytes() == b"1234" * 10
+    with open(backup_path, 'rb') as fobj:
+        assert fobj.read() == b"4321" * 10  # What it held before this swap
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason="needs os.symlink")
+def test_byteswap_through_symlink(tmp_path):
+    """Test that byteswap rewrites a symlink's target rather than the link"""
+    target = tmp_path / "target_dump"
+    link = tmp_path / "fake_dump"
+    target.write_bytes(b"1234" * 10)
+    os.symlink(str(target), str(link))
+
+    byteswap(str(link))
+    assert os.path.islink(str(link))
+    assert target.read_bytes() == b"4321" * 10
+
+    # The backup is a copy of the original data, not a copy of the symlink
+    backup_path = str(link) + '.bak'
+    assert not os.path.islink(backup_path)
+    with open(backup_path, 'rb') as fobj:
+        assert fobj.read() == b"1234" * 10
+
+def test_byteswap_padding(fake_dump):
     """Test that byteswap pads as intended"""
-    test_file = tmpdir.join("fake_dump")
-    test_file.write("1234" * 100000)
-    byteswap(str(test_file), pad_to=500000)
-    assert test_file.read() == ("4321" * 100000) + ("\x00" * 100000)
+    fake_dump.write_bytes(BIG_DUMP)
+    byteswap(str(fake_dump), pad_to=500000)
+    assert fake_dump.read_bytes() == BIG_DUMP_PADDED
 
-def test_byteswap_with_incomplete(tmpdir):
+def test_byteswap_with_incomplete(fake_dump):
     """Test that byteswap reacts properly to file sizes with remainders
 
     (ie. file sizes that are not evenly divisible by 2 or 4)
     """
-    import pytest
-    test_file = tmpdir.join("fake_dump")
 
     # Define a function which will be called for each combination of inputs
     def test_callback(_bytes, _words, pad_to):
         """Function called many times by _vary_check_swap_inputs"""
         # Test that both types of swapping error out on odd-numbered lengths
-        test_file.write("12345")
+        fake_dump.write_bytes(b"12345")
         if _bytes or _words:
             with pytest.raises(FileIncomplete):
-                byteswap(str(test_file), _bytes, _words, pad_to)
+                byteswap(str(fake_dump), _bytes, _words, pad_to)
 
-        test_file.write("123456")
+        fake_dump.write_bytes(b"123456")
         if _words:
             with pytest.raises(FileIncomplete):
-                byteswap(str(test_file), _bytes, _words, pad_to)
+                byteswap(str(fake_dump), _bytes, _words, pad_to)
         else:
-            byteswap(str(test_file), False, _words, pad_to)
+            byteswap(str(fake_dump), False, _words, pad_to)
 
     # Let _vary_check_swap_inputs call test_callback once for each combination
     _vary_check_swap_inputs(test_callback)
 
-def test_process_path_autopad_error(tmpdir):
+@pytest.mark.parametrize("pad_to", (0, 1000, 2048))
+def test_byteswap_incomplete_padding(fake_dump, pad_to):
+    """Test that byteswap doesn't pad or back up files it can't swap"""
+    backup_path = str(fake_dump) + '.bak'
+
+    fake_dump.write_bytes(b"123456")
+    with pytest.raises(FileIncomplete):
+        byteswap(str(fake_dump), pad_to=pad_to)
+    assert fake_dump.read_bytes() == b"123456"  # Unchanged on error
+    assert not os.path.exists(backup_path)
+
+def test_process_path_autopad_error(fake_dump):
     """Test that process_path reacts to pad_to=None properly on error"""
-    import pytest
-    test_file = tmpdir.join("fake_dump")
-    backup_path = str(test_file) + '.bak'
+    backup_path = str(fake_dump) + '.bak'
 
-    test_file.write("1234" * 100000)
+    fake_dump.write_bytes(BIG_DUMP)
     assert not os.path.exists(backup_path)
     with pytest.raises(FileTooBig):
-        process_path(str(test_file), pad_to=None)
-    assert test_file.read() == "1234" * 100000  # Unchanged on error
-    assert not os.path.exists(backup_path)      # No backup on oversize
-
-def test_process_path_padding(tmpdir):
-    """Test that process_path pads properly"""
-    test_file = tmpdir.join("fake_dump")
-    backup_path = str(test_file) + '.bak'
-
-    test_file.write("1234" * 100000)
-    process_path(str(test_file), pad_to=500000)
-    assert test_file.read() == ("4321" * 100000) + ("\x00" * 100000)
-    assert os.path.exists(backup_path)
-
-def test_process_path_nopad(tmpdir):
-    """Test that process_path reacts to pad_to=0 properly"""
-    test_file = tmpdir.join("fake_dump")
-    backup_path = str(test_file) + '.bak'
-
-    test_file.write("1234" * 100000)
-    process_path(str(test_file), pad_to=0)
-    assert test_file.read() == "4321" * 100000
-    assert os.path.exists(backup_path)
+        process_path(str(fake_dump), pad_to=None)
+    assert fake_dump.read_bytes() == BIG_DUMP  # Unchanged on error
+    assert not os.path.exists(backup_path)     # No backup on oversize
 
 def check_main_retcode(args, code):
     """Helper for testing return codes from main()"""
@@ -130,49 +157,129 @@ def check_main_retcode(args, code):
     except SystemExit as err:
         assert err.code == code
 
-def test_main_works(tmpdir):
-    """Functional test for basic main() use"""
-    test_file = tmpdir.join("fake_dump")
-    backup_path = str(test_file) + '.bak'
-
-    # Test successful runs
-    for pat_reps, options, expect_pat, expect_len, backup in (
-            (500, [], '4321', 2048, False),
-            (100, ['--swap-mode=words-only'], '3412', 512, True),
-            (1000, ['--swap-mode=bytes-only'], '2143', 32768, False),
-            (1000, ['--force-padding=0',
-                    '--swap-mode=bytes-only'], '2143', 4000, False),
-            (100000, ['--force-padding=500000'], '4321', 500000, True)):
-
-        bkopt = [] if backup else ['--no-backup']
-        test_file.write("1234" * pat_reps)
-        with set_argv(options + bkopt + [test_file]):
-            main()
-        assert test_file.read() == (expect_pat * pat_reps) + (
-            "\x00" * (expect_len - (4 * pat_reps)))
-        if backup:
-            assert os.path.exists(backup_path)
-            os.remove(backup_path)
-
-def test_main_missing_file(tmpdir):
+@pytest.mark.parametrize("pat_reps,options,expect_pat,expect_len", (
+        (500, {'make_backup': False}, b'4321', 2048),
+        (100, {'swap_bytes': False}, b'3412', 512),
+        (1000, {'swap_words': False, 'make_backup': False}, b'2143', 32768),
+        (1000, {'swap_words': False, 'pad_to': 0, 'make_backup': False},
+         b'2143', 4000),
+        (100000, {'pad_to': 500000}, b'4321', 500000),
+        # pad_to=0 also skips the FileTooBig check, so oversize files work
+        (100000, {'pad_to': 0}, b'4321', 400000)))
+def test_process_path_works(fake_dump, pat_reps, options, expect_pat,
+                            expect_len):
+    """Test process_path with a representative set of arguments"""
+    backup_path = str(fake_dump) + '.bak'
+
+    fake_dump.write_bytes(b"1234" * pat_reps)
+    process_path(str(fake_dump), **options)
+    assert fake_dump.read_bytes() == (expect_pat * pat_reps) + (
+        b"\x00" * (expect_len - (4 * pat_reps)))
+    if options.get('make_backup', True):
+        with open(backup_path, 'rb') as fobj:
+            assert fobj.read() == b"1234" * pat_reps
+    else:
+        assert not os.path.exists(backup_path)
+
+@pytest.mark.parametrize("options,expected", (
+        ([], {}),
+        (['--swap-mode=words-only'], {'swap_bytes': False}),
+        (['--swap-mode=bytes-only', '--no-backup'],
+         {'swap_words': False, 'make_backup': False}),
+        (['--force-padding=0', '--swap-mode=bytes-only'],
+         {'swap_words': False, 'pad_to': 0}),
+        (['--force-padding=500000'], {'pad_to': 500000})))
+def test_main_works(monkeypatch, options, expected):
+    """Test that main() translates its arguments for process_path properly
+
+    (process_path itself is covered by test_process_path_works, so this
+     only needs to check what main() passes to it.)
+    """
+    calls = []
+    monkeypatch.setattr("saveswap.process_path",
+                        lambda **kwargs: calls.append(kwargs))
+
+    with set_argv(options + ['fake_dump']):
+        main()
+
+    expected_kwargs = {'path': 'fake_dump', 'swap_bytes': True,
+                       'swap_words': True, 'pad_to': None,
+                       'make_backup': True}
+    expected_kwargs.update(expected)
+    assert calls == [expected_kwargs]
+
+def test_main_multiple_files(tmp_path):
+    """Functional test for main() with more than one path"""
+    test_files = [tmp_path / "fake_dump{}".format(x) for x in range(4)]
+    for test_file in test_files:
+        test_file.write_bytes(b"1234" * 100)
+    with set_argv(['--no-backup'] + test_files):
+        main()
+    for test_file in test_files:
+        assert test_file.read_bytes() == b"4321" * 100 + b"\x00" * 112
+
+    # The same file twice must be swapped twice, in order
+    test_file = test_files[0]
+    test_file.write_bytes(b"1234" * 128)
+    with set_argv(['--no-backup', test_file, str(test_file)]):
+        main()
+    assert test_file.read_bytes() == b"1234" * 128
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason="needs os.link")
+def test_main_same_file_serial(tmp_path, monkeypatch):
+    """Test that main() doesn't process one file under two names at once"""
+    real_executor = concurrent.futures.ThreadPoolExecutor
+    workers = []
+
+    def recording_executor(max_workers):
+        """Wrapper to record how many threads main() asked for"""
+        workers.append(max_workers)
+        return real_executor(max_workers=max_workers)
+    monkeypatch.setattr(concurrent.futures, "ThreadPoolExecutor",
+                        recording_executor)
+
+    # Two hardlinked names must be swapped twice, in order
+    test_file = tmp_path / "fake_dump"
+    hardlink = tmp_path / "other_name"
+    test_file.write_bytes(b"1234" * 128)
+    os.link(str(test_file), str(hardlink))
+    with set_argv(['--no-backup', test_file, hardlink]):
+        main()
+    assert test_file.read_bytes() == b"1234" * 128
+    assert workers == [1]
+
+    # A path and the file its backup will be written to
+    backup_path = tmp_path / "fake_dump.bak"
+    backup_path.write_bytes(b"1234" * 128)
+    with set_argv([test_file, backup_path]):
+        main()
+    assert workers == [1, 1]
+
+    # ...but unrelated files still get processed in parallel
+    unrelated = tmp_path / "unrelated"
+    unrelated.write_bytes(b"1234" * 128)
+    with set_argv(['--no-backup', test_file, unrelated]):
+        main()
+    assert workers == [1, 1, 2]
+
+def test_main_missing_file(tmp_path):
     """Functional test for main() with nonexistant path"""
-    missing_path = str(tmpdir.join("missing_file"))
+    missing_path = str(tmp_path / "missing_file")
     check_main_retcode([missing_path], 10)
     assert not os.path.exists(missing_path + '.bak')
 
-def test_main_error_returns(tmpdir):
+def test_main_error_returns(fake_dump):
     """Functional test for main() with erroring input"""
-    test_file = tmpdir.join("fake_dump")
-    backup_path = str(test_file) + '.bak'
+    backup_path = str(fake_dump) + '.bak'
 
     assert not os.path.exists(backup_path)
-    test_file.write("1234" * 100000)  # Too big
-    check_main_retcode([test_file], 20)
+    fake_dump.write_bytes(BIG_DUMP)   # Too big
+    check_main_retcode([fake_dump], 20)
     assert not os.path.exists(backup_path)
 
-    test_file.write("12345")          # Not evenly disible by 2
-    check_main_retcode([test_file], 30)
-    # TODO: Fix the code so the backup is removed on this failure
+    fake_dump.write_bytes(b"12345")   # Not evenly disible by 2
+    check_main_retcode([fake_dump], 30)
+    assert not os.path.exists(backup_path)
 
 def _vary_check_swap_inputs(callback):
     """Helper to avoid duplicating stuff within test_byteswap_with_incomplete
@@ -182,5 +289,7 @@ def _vary_check_swap_inputs(callback):
     """
     for _bytes in (True, False):
         for _words in (True, False):
-            for _padding in (0, 1000, 2048):
+            # (Only one padding value, since the stride check happens before
+            #  padding. See test_byteswap_incomplete_padding for the rest.)
+            for _padding in (0,):
                 callback(_bytes, _words, _padding)